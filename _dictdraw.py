@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # -*- encoding: utf-8 -*-
 
+from collections import namedtuple
 from math import ceil, pi
 import cairo, sys, gtk
 import _dictinfo
@@ -8,11 +9,18 @@ from IPython.Debugger import Tracer; debug_here = Tracer()
 
 from contextlib import contextmanager
 
+_bits_cache = {}
+
 def bits(n):
-    sign = '1' if n < 0 else '0'
-    m = n if n >= 0 else (n + 2**31)
-    s = '%31s' % bin(m)[2:][-31:]
-    return sign + s.replace(' ', '0')
+    """Return a sign bit followed by the low 31 bits of `n`, memoized."""
+    try:
+        return _bits_cache[n]
+    except KeyError:
+        pass
+    if len(_bits_cache) >= 4096:
+        _bits_cache.clear()
+    s = _bits_cache[n] = ('1' if n < 0 else '0') + format(n & 0xFFFFFFFF, '032b')[-31:]
+    return s
 
 def myrepr(obj):
     if isinstance(obj, unicode):
@@ -39,37 +47,119 @@ def center_text(cr, x, y, text):
     cr.show_text(text)
     cr.fill()
 
-def draw_textbox(cr, texts, rectcolor):
-    with save(cr):
-        colors = [ a for i, a in enumerate(texts) if i%2 == 0 ]
-        texts = [ a for i, a in enumerate(texts) if i%2 == 1 ]
+_extents_cache = {}
+
+def m_extents(cr, n):
+    """Return the extents of `n` 'M' characters at the current font size."""
+    key = (cr.get_font_matrix().xx, n)
+    try:
+        return _extents_cache[key]
+    except KeyError:
+        extents = _extents_cache[key] = cr.text_extents(u'M' * n)
+        return extents
+
+class Batch(object):
+    """Textboxes whose drawing has been deferred so that they can share fills.
+
+    Every rectangle of a given color goes into a single path that is filled
+    once, and the text is then drawn atop all of the rectangles.
+    """
+    def __init__(self):
+        self.rects = {}  # color -> [(x, y, width, height), ...]
+        self.texts = []  # [(x, y, [(color, text), ...]), ...]
+
+    def flush(self, cr):
+        """Draw everything in the batch onto `cr`, then empty the batch."""
+        for rectcolor, rects in self.rects.items():
+            for rect in rects:
+                cr.rectangle(*rect)
+            set_source(cr, rectcolor)
+            cr.fill()
+
+        source = None
+        for x, y, runs in self.texts:
+            cr.move_to(x, y)
+            for color, text in runs:
+                if color != source:
+                    set_source(cr, color)
+                    source = color
+                if text == '/':  # special code for not-equals
+                    with save(cr):   # so the '/' will display atop the '='
+                        cr.show_text('=')
+                cr.show_text(text)
+
+        self.rects = {}
+        self.texts = []
+
+def textbox_height(cr):
+    """Return the height of a textbox drawn at the current font size."""
+    theight = ceil(m_extents(cr, 1)[3])
+    return theight + 2 * ceil(theight / 3)
+
+def textbox_width(cr, n):
+    """Return the width of a textbox holding `n` characters."""
+    theight = ceil(m_extents(cr, 1)[3])
+    return ceil(m_extents(cr, n)[2]) + 2 * ceil(theight / 3)
+
+def draw_textbox(cr, texts, rectcolor, batch=None):
+    """Draw a textbox at the current point and move to its right edge.
+
+    If `batch` is supplied the drawing is deferred until `batch.flush()`.
+    """
+    colors = texts[0::2]
+    texts = texts[1::2]
+
+    x, y = cr.get_current_point()
+
+    extents = m_extents(cr, len(''.join(texts)))
+    ty = ceil(extents[1])
+    twidth = ceil(extents[2])
+    theight = ceil(extents[3])
+
+    padding = ceil(theight / 3)
+
+    width = twidth + 2 * padding
+    height = theight + 2 * padding
+
+    # Join adjacent segments of the same color so each is shown in one call.
+    runs = []
+    for color, text in zip(colors, texts):
+        if runs and runs[-1][0] == color and '/' not in (runs[-1][1], text):
+            runs[-1] = (color, runs[-1][1] + text)
+        else:
+            runs.append((color, text))
 
-        x, y = cr.get_current_point()
-        cr.translate(x, y)
+    flush = batch is None
+    if flush:
+        batch = Batch()
+    batch.rects.setdefault(rectcolor, []).append((x, y, width, height))
+    batch.texts.append((x + padding, y + padding + -ceil(ty), runs))
+    if flush:
+        batch.flush(cr)
 
-        extents = cr.text_extents(u'M' * len(''.join(texts)))
-        ty = ceil(extents[1])
-        twidth = ceil(extents[2])
-        theight = ceil(extents[3])
+    cr.move_to(x + width, y)
+    return height
 
-        padding = ceil(theight / 3)
+def draw_blank_row(cr, widths, height, gap, rectcolor, batch=None):
+    """Draw adjacent empty textboxes of the given `widths`, `gap` apart.
 
-        width = twidth + 2 * padding
-        height = theight + 2 * padding
-        cr.rectangle(0,0, width,height)
-        cr.set_source_rgb(*rectcolor)
-        cr.fill()
+    Blank boxes have no text, so they are neither measured nor shown; only
+    their rectangles are drawn.  The current point is left at the right edge
+    of the last box.
+    """
+    x, y = cr.get_current_point()
 
-        cr.move_to(padding, padding + -ceil(ty))
-        for i in range(len(colors)):
-            cr.set_source_rgb(*colors[i])
-            if texts[i] == '/':  # special code for not-equals
-                with save(cr):   # so the '/' will display atop the '='
-                    cr.show_text('=')
-            cr.show_text(texts[i])
+    flush = batch is None
+    if flush:
+        batch = Batch()
+    rects = batch.rects.setdefault(rectcolor, [])
+    for width in widths:
+        rects.append((x, y, width, height))
+        x += width + gap
+    if flush:
+        batch.flush(cr)
 
-    cr.rel_move_to(width, 0)
-    return height
+    cr.move_to(x - gap, y)
 
 def draw_arrowhead(cr, x, y):
     with save(cr):
@@ -87,140 +177,198 @@ gold = (1, 0.9, 0.5)
 gray = (0.5, 0.5, 0.5)
 lightgray = (0.8, 0.8, 0.8)
 
+_patterns = {}  # color -> cairo.SolidPattern
+
+def set_source(cr, color):
+    """Make `color` the source of `cr`, reusing a single pattern per color."""
+    try:
+        pattern = _patterns[color]
+    except KeyError:
+        pattern = _patterns[color] = cairo.SolidPattern(*color)
+    cr.set_source(pattern)
+
 def draw_button(cr, x, y, is_collision=True):
     """Draw a green or red circle showing a hit or a collision."""
     with save(cr):
         cr.translate(x, y)
 
         if is_collision:
-            cr.set_source_rgb(*red)
+            set_source(cr, red)
         else:
-            cr.set_source_rgb(*green)
+            set_source(cr, green)
 
         cr.set_font_size(32)
         cr.arc(0, 0, 13.5, 0, pi * 2)  # red or green circle
         cr.fill()
 
         if is_collision:
-            cr.set_source_rgb(*white)
+            set_source(cr, white)
             center_text(cr, 0.8, -1, '×')
 
 cr = None
 
-def draw_dictionary(cr, d, *lookup_paths):
-    """Supply `d` a Python dictionary."""
-    o = _dictinfo.dictobject(d)
-
-    WIDTH=960
-    if len(o) == 8:
-        HEIGHT=406
+# How a table is laid out.  `hashwidth` is the width of the hash field, and
+# `height` is the height of the whole picture.
+Layout = namedtuple('Layout',
+                    'xoffset hashwidth font_size gap show_value height')
+
+# The layouts of particular table sizes; others use generic_layout().
+LAYOUTS = {
+    8: Layout(140, 9, 36, 2, True, 406),
+    32: Layout(360, 16, 10, 0, True, 480),
+    }
+
+def generic_layout(sigbits):
+    """Return the layout of a table whose slot indexes have `sigbits` bits."""
+    return Layout(140, sigbits + 1, 10, 0, False, 480)
+
+def draw_key(cr, key, value, gap, batch):
+    """Draw the key cell that ends a row of a table without values."""
+    draw_textbox(cr, [white, key], gray, batch)
+
+def draw_key_and_value(cr, key, value, gap, batch):
+    """Draw the key and value cells that end a row of a table with values.
+
+    A `value` of NULL, as in a dummy slot, gets a blank cell.
+    """
+    draw_textbox(cr, [white, key], gray, batch)
+    cr.rel_move_to(gap, 0)
+    if value is _dictinfo.NULL:
+        draw_textbox(cr, [white, u' ' * VALWIDTH], gray, batch)
     else:
-        HEIGHT=480
+        draw_textbox(cr, [white, u'%-9s' % myrepr(value)], gray, batch)
+
+def table_layout(o):
+    """Return the layout for drawing the dictobject `o`."""
+    try:
+        return LAYOUTS[len(o)]
+    except KeyError:
+        return generic_layout(o.ma_mask.bit_length())
 
+_static_layers = {}  # table size -> ImageSurface
+
+def draw_table(cr, o, layout, static):
+    """Draw the slots of the dictobject `o` according to `layout`.
+
+    If `static` is true, draw only what depends on nothing but the size of the
+    table: the background, the header, and the column of slot indexes.
+    Otherwise draw everything else, leaving space for those parts.  Returns
+    the ``(xoffset, yoffset, height, gap)`` of the table layout.
+    """
     cr.select_font_face('Inconsolata',
                         cairo.FONT_SLANT_NORMAL,
                         cairo.FONT_WEIGHT_BOLD)
 
-    cr.rectangle(0,0, WIDTH,HEIGHT)
-    cr.set_source_rgb(1,1,1)
-    cr.fill()
+    if static:
+        cr.set_source_rgb(1,1,1)
+        cr.paint()
 
     with save(cr):
 
-        mask = o.ma_mask
-        sigbits = 0
-        while mask:
-            sigbits += 1
-            mask >>= 1
-
-        if len(o) == 8:
-            xoffset = 140
-            hashwidth = 9 # width of the hash field
-            font_size = 36
-            gap = 2
-            show_value = True
-        else:
-            if len(o) == 32:
-                xoffset = 360
-                hashwidth = 16 # width of the hash field
-                show_value = True
-            else:
-                xoffset = 140
-                hashwidth = sigbits + 1 # width of the hash field
-                show_value = False
-            font_size = 10
-            gap = 0
+        sigbits = o.ma_mask.bit_length()
+
+        xoffset, hashwidth, gap = layout.xoffset, layout.hashwidth, layout.gap
 
-        yoffset = font_size # room for header at top
+        yoffset = layout.font_size # room for header at top
 
-        cr.set_font_size(font_size)
-        charwidth = cr.text_extents(u'M')[2]
+        cr.set_font_size(layout.font_size)
+        charwidth = m_extents(cr, 1)[2]
         width = 100 #actually compute from font size later
 
         cr.translate(xoffset, yoffset)  # upper-left corner of the dictionary
 
-        with save(cr):
-            cr.set_source_rgb(0,0,0)
-            cr.translate(2,-6)
-            if len(o) == 8:
-                cr.show_text(u'Idx      Hash     Key     Value')
+        if static:
+            with save(cr):
+                cr.set_source_rgb(0,0,0)
+                cr.translate(2,-6)
+                if len(o) == 8:
+                    cr.show_text(u'Idx      Hash     Key     Value')
+
+        height = textbox_height(cr)
+        index_width = textbox_width(cr, sigbits)
+        empty_widths = [textbox_width(cr, n) for n in (1, hashwidth, VALWIDTH)]
+        if layout.show_value:
+            empty_widths.append(textbox_width(cr, VALWIDTH))
+            draw_cells = draw_key_and_value
+        else:
+            draw_cells = draw_key
+        batch = Batch()
+        hashes, keys, values = o.entries()
 
-        height = 0
+        # Bind what the loop looks up on every slot to locals.
+        NULL, dummy, ma_mask = _dictinfo.NULL, _dictinfo.dummy, o.ma_mask
+
+        # Only rows that overlap the clip region (the exposed area) are drawn.
+        clip_top, clip_bottom = cr.clip_extents()[1::2]
+
+        # The upper-left corner of each slot's row; slots run down in columns
+        # of 32, each 176 units to the right of the last.
+        xs = [176 * (i // 32) for i in range(len(o))]
+        ys = [(i // 32 + 1) * gap + (i % 32) * (height + gap)
+              for i in range(len(o))]
 
         for i in range(len(o)):
-            if i == 0 or i % 32:
-                cr.rel_move_to(0, height + gap)
+            y = ys[i]
+            if y > clip_bottom or y + height < clip_top:
+                continue
+
+            cr.move_to(xs[i], y)
+            if static:
+                draw_textbox(cr, [gold, bits(i)[-sigbits:]], gray, batch)
+                continue
+            cr.rel_move_to(index_width + gap, 0)
+
+            k = keys[i]
+            if k is NULL:
+                # This is a completely empty entry.
+                draw_blank_row(cr, empty_widths, height, gap, lightgray, batch)
+                continue
+
+            if k is dummy:
+                draw_textbox(cr, [white, u'!'], red, batch)
+                cr.rel_move_to(gap, 0)
+                draw_blank_row(cr, empty_widths[1:2], height, gap, gray, batch)
+                cr.rel_move_to(gap, 0)
+                draw_cells(cr, u'<dummy>', values[i], gap, batch)
+                continue
+
+            h = hashes[i]
+
+            if h & ma_mask == i:
+                draw_textbox(cr, [white, u'='], green, batch)
             else:
-                cr.rel_move_to(176, -31 * height + -30 * gap)
+                draw_textbox(cr, [white, u'/'], red, batch)
+            cr.rel_move_to(gap, 0)
+            bstr = bits(h)[-hashwidth+1:]
+            texts = [lightgray, u'…' + bstr[:-sigbits],
+                     gold, bstr[-sigbits:]]
+            draw_textbox(cr, texts, gray, batch)
+            cr.rel_move_to(gap, 0)
+            draw_cells(cr, u'%-9s' % myrepr(k), values[i], gap, batch)
 
-            with save(cr):
-                entry = o.ma_table[i]
+        batch.flush(cr)
 
-                height = draw_textbox(cr, [gold, bits(i)[-sigbits:]], gray)
-                cr.rel_move_to(gap, 0)
+    return xoffset, yoffset, height, gap
 
-                try:
-                    k = entry.me_key
-                except ValueError:
-                    # This is a completely empty entry.
-                    draw_textbox(cr, [white, u' '], lightgray)
-                    cr.rel_move_to(gap, 0)
-                    draw_textbox(cr, [white, u' ' * hashwidth], lightgray)
-                    cr.rel_move_to(gap, 0)
-                    draw_textbox(cr, [white, u' ' * VALWIDTH], lightgray)
-                    if show_value:
-                        cr.rel_move_to(gap, 0)
-                        draw_textbox(cr, [white, u' ' * VALWIDTH], lightgray)
-                    continue
-
-                if k is _dictinfo.dummy:
-                    draw_textbox(cr, [white, u'!'], red)
-                    cr.rel_move_to(gap, 0)
-                    draw_textbox(cr, [white, u' ' * hashwidth], gray)
-                    cr.rel_move_to(gap, 0)
-                    draw_textbox(cr, [white, u'<dummy>'], gray)
-                    if show_value:
-                        cr.rel_move_to(gap, 0)
-                        draw_textbox(cr, [white, u' ' * VALWIDTH], gray)
-                    continue
-
-                h = entry.me_hash
-                v = entry.me_value
-
-                if h & o.ma_mask == i:
-                    draw_textbox(cr, [white, u'='], green)
-                else:
-                    draw_textbox(cr, [white, u'/'], red)
-                cr.rel_move_to(gap, 0)
-                bstr = bits(h)[-hashwidth+1:]
-                texts = [lightgray, u'…' + bstr[:-sigbits],
-                         gold, bstr[-sigbits:]]
-                draw_textbox(cr, texts, gray)
-                cr.rel_move_to(gap, 0)
-                draw_textbox(cr, [white, u'%-9s' % myrepr(k)], gray)
-                if show_value:
-                    cr.rel_move_to(gap, 0)
-                    draw_textbox(cr, [white, u'%-9s' % myrepr(v)], gray)
+def draw_dictionary(cr, d, *lookup_paths):
+    """Supply `d` a Python dictionary."""
+    o = _dictinfo.dictobject(d)
+    layout = table_layout(o)
+
+    # The parts of the picture that depend only on the size of the table are
+    # drawn once and then painted in under everything else on each redraw.
+    layer = _static_layers.get(len(o))
+    if layer is None:
+        # Large tables run past WIDTH, one 176-unit column per 32 slots.
+        columns = (len(o) + 31) // 32
+        width = max(WIDTH, layout.xoffset + 176 * columns)
+        layer = cairo.ImageSurface(cairo.FORMAT_RGB24, width, layout.height)
+        draw_table(cairo.Context(layer), o, layout, True)
+        _static_layers[len(o)] = layer
+    cr.set_source_surface(layer, 0, 0)
+    cr.paint()
+
+    xoffset, yoffset, height, gap = draw_table(cr, o, layout, False)
 
     for lookup_path in lookup_paths:
         with save(cr):
@@ -228,7 +376,7 @@ def draw_dictionary(cr, d, *lookup_paths):
             cr.translate(xoffset, yoffset)
 
             y = 2 + n * (height + gap + 0.5) + height / 2
-            cr.set_source_rgb(*black)
+            set_source(cr, black)
             cr.set_line_width(6)
             cr.move_to(-100, y)
             cr.rel_line_to(40, 0)
@@ -254,7 +402,7 @@ def draw_dictionary(cr, d, *lookup_paths):
                 y0 = min(yf, yd)
                 y1 = max(yf, yd)
 
-                cr.set_source_rgb(*black)
+                set_source(cr, black)
                 cr.set_line_width(6)
                 cr.move_to(690, y0)
                 cr.arc(690, (y0 + y1) / 2, (y1 - y0) / 2, 3 * pi / 2, pi / 2)
@@ -1,15 +1,11 @@
 """Routines that examine the internals of a CPython dictionary."""
 
-from ctypes import Structure, c_ulong, POINTER, cast, py_object
+from ctypes import Structure, c_ulong, c_void_p, POINTER, cast, py_object
 from math import log
 
-UMAX = 2 ** 32
-
 def cbin(n):
     """Return `n` as a clean 32-bit binary number, without a leading '0b'."""
-    if n < 0:
-        n = UMAX + n
-    return '{0:0>32}'.format(bin(n)[2:])
+    return format(n & 0xFFFFFFFF, '032b')
 
 # Create a singleton with which the dictionary routines below can
 # represent null C pointers.
@@ -34,6 +30,14 @@ class PyDictEntry(Structure):
     def __unicode__(obj):
         return 'DictEntry({obj.me_hash}, {obj.me_key}, {obj.me_value})'.format(obj=obj)
 
+class RawDictEntry(Structure):
+    """An entry in a dictionary, with its key and value as bare pointers."""
+    _fields_ = [
+        ('me_hash', c_ulong),
+        ('me_key', c_void_p),
+        ('me_value', c_void_p),
+        ]
+
 class PyDictObject(Structure):
     """A dictionary object."""
     _fields_ = [
@@ -60,6 +64,28 @@ class PyDictObject(Structure):
                 return i
         raise KeyError('cannot find key %r' % (key,))
 
+    def entries(self):
+        """Return parallel lists of the hash, key, and value of every slot.
+
+        The key and value of an empty slot are both `NULL`, as is the value
+        of a dummy slot.  The table is walked once, and NULL pointers are
+        detected without raising a ValueError for every empty slot.
+        """
+        table = self.ma_table
+        raw = cast(table, POINTER(RawDictEntry))
+        hashes, keys, values = [], [], []
+        for i in range(len(self)):
+            r = raw[i]
+            hashes.append(r.me_hash)
+            if r.me_key is None:
+                keys.append(NULL)
+                values.append(NULL)
+                continue
+            entry = table[i]
+            keys.append(entry.me_key)
+            values.append(entry.me_value if r.me_value else NULL)
+        return hashes, keys, values
+
     def slot_map(self):
         """Return a mapping of keys to their integer slot numbers."""
         m = {}
@@ -1,15 +1,14 @@
 """Routines that examine the internals of a CPython set."""
 
 from ctypes import Structure, c_ulong, POINTER, cast, py_object
+from functools import lru_cache
 from math import log
+import sys
 
-UMAX = 2 ** 32
-
+@lru_cache(maxsize=4096)
 def cbin(n):
     """Return `n` as a clean 32-bit binary number, without a leading '0b'."""
-    if n < 0:
-        n = UMAX + n
-    return '{0:0>32}'.format(bin(n)[2:])
+    return format(n & 0xFFFFFFFF, '032b')
 
 # Create a singleton with which the set routines below can represent null C
 # pointers.
@@ -23,6 +22,24 @@ class NULL(object):
 
 NULL = NULL()
 
+# Follow the same sequence of slots that CPython does when it looks up a key.
+
+PERTURB_SHIFT = 5
+
+def probe_sequence(h, mask):
+    """Yield, forever, the slots that CPython probes for a key whose hash is `h`.
+
+    The search starts at ``h & mask`` and then steps with
+    ``i = 5*i + 1 + perturb``, where `perturb` starts as the hash and is
+    shifted right by PERTURB_SHIFT bits after each step.
+    """
+    perturb = c_ulong(h).value  # unsigned, just as it is stored in the table
+    i = perturb & mask
+    while True:
+        yield i
+        i = (5 * i + 1 + perturb) & mask
+        perturb >>= PERTURB_SHIFT
+
 # Create Structures representing the set object and entries, and
 # give them useful methods making them easier to use.
 
@@ -58,28 +75,39 @@ class PySetObject(Structure):
         """Return the number of set entry slots."""
         return self.mask + 1
 
+    def words(self):
+        """Return the table as a flat list of C words: hash, key, hash, ...
+
+        The whole table is copied out in a single slice, so the hashes and the
+        key addresses can then be scanned at C speed with ``words[0::2]`` and
+        ``words[1::2]``.  A NULL key is 0.
+        """
+        n = 2 * len(self)
+        return cast(self.table, POINTER(c_ulong * n)).contents[:]
+
     def slot_of(self, key):
-        """Find and return the slot at which `key` is stored."""
-        for i in range(len(self)):
+        """Find and return the slot at which `key` is stored.
+
+        Like CPython's own lookup, this follows the probe sequence of the
+        key's hash until it finds the key or reaches an empty slot.
+        """
+        h = c_ulong(hash(key)).value
+        for i in probe_sequence(h, self.mask):
+            entry = self.table[i]
             try:
-                k = self.table[i].key
+                k = entry.key
             except ValueError:
-                continue  # key is NULL
-            if (k is key) or (k == key):
-                return i
+                break  # key is NULL, so `key` is not in the set
+            if (k is key) or (entry.hash == h and k == key):
+                return int(i)   # since slot often arrives as a long
         raise KeyError('cannot find key %r' % (key,))
 
     def slot_map(self):
-        """Return a mapping of keys to their integer slot numbers."""
-        m = {}
-        for i in range(len(self)):
-            entry = self.table[i]
-            try:
-                entry.key
-            except:
-                continue  # key is NULL
-            m[i] = entry.key
-        return m
+        """Return a mapping of slot numbers to the keys stored in them."""
+        dummy_address = id(dummy)
+        return dict((i, self.table[i].key)
+                    for i, address in enumerate(self.words()[1::2])
+                    if address and address != dummy_address)
 
 def setobject(s):
     """Return the PySetObject lying behind the Python set `s`."""
@@ -96,37 +124,24 @@ s.remove(0)
 dummy = setobject(s).table[0].key
 del s
 
-def _probe_steps(dummyset, key, final_slot):
-    """Find the slots searched to put `key` in `final_slot` of `dummyset`.
+def _probe_steps(s, key, final_slot):
+    """Find the slots searched to put `key` in `final_slot` of the set `s`.
 
-    The `dummyset` should be a set in which `key` once resided in position
-    `final_slot`, but whose entries have all been deleted, leaving dummy
-    entries. This routine will repeatedly try to insert `key` into the set, and
-    each time that it does not land at `final_slot` an obstacle is placed where
-    it has landed instead, until finally the obstacles make `key` land in the
-    `final_slot`.
+    Rather than repeatedly inserting `key` and blocking each slot that it lands
+    in, this routine follows the probe_sequence() of its hash.  A slot that the
+    sequence revisits is skipped, since the key could never land there twice.
 
     A list of the slots searched is returned. The last element of this list will
     always be `final_slot`.
     """
-    o = setobject(dummyset)
-
-    # Compute the first slot rather than do an expensive search.
-    slot = hash(key) & o.mask
-    slots = [ int(slot) ]   # since slot often arrives as a long
-
-    # Keep adding obstacles until `key` winds up in `final_slot`.
-    while slots[-1] != final_slot:
-        if slot == key:  # make sure the integer `slot` is not `key` itself
-            slot += len(o)
-        o.table[slot] = setentry(hash(key), None)
-        #dummyset[slot] = None  # add the obstacle
-
-        #dummyset[key] = None  # add the key
-        dummyset.add(key)
-        slot = o.slot_of(key)
-        slots.append(slot)
-        dummyset.remove(key)
+    slots = []
+    seen = set()
+    for i in probe_sequence(hash(key), setobject(s).mask):
+        if i not in seen:
+            slots.append(int(i))   # since slot often arrives as a long
+            seen.add(i)
+        if i == final_slot:
+            break
 
     # Return the sequence of slots that we searched.
     return slots
@@ -140,13 +155,7 @@ def probe_steps(keys, key):
     # Create a set with the given `keys` and figure out at which
     # slot the target `key` wound up.
     s = set(keys)
-    o = setobject(s)
-    final_slot = o.slot_of(key)
-
-    # Empty the set so that it contains only dummy entries, then
-    # pass it to the internal _probe_steps() routine.
-    for k in list(s):
-        s.remove(k)
+    final_slot = setobject(s).slot_of(key)
     return _probe_steps(s, key, final_slot)
 
 def probe_all_steps(keys):
@@ -159,37 +168,29 @@ def probe_all_steps(keys):
     """
     # Create a set with the given `keys` and find out in which
     # slot each key wound up.
-    d = set.fromkeys(keys)
-    o = setobject(d)
-    m = o.slot_map()
+    s = set(keys)
+    slots = setobject(s).slot_map()
 
     # For each key in the set, find its probe list.
-    for key, final_slot in m.items():
-        for k in list(d):
-            del d[k]  # empty the set
-        m[key] = _probe_steps(d, key, final_slot)
-    return m
+    return dict((key, _probe_steps(s, key, final_slot))
+                for final_slot, key in slots.items())
 
 def display_set(d):
     """Print a set hash table to the screen."""
     do = setobject(d)
-    bits = int(log(do.ma_mask + 1, 2))
-    for i in range(len(do)):
-        entry = do.ma_table[i]
+    bits = int(log(len(do), 2))
+    words = do.words()
+    rows = []
+    for i, (h, address) in enumerate(zip(words[0::2], words[1::2])):
         entry_bits = cbin(i)[-bits:]
-        try:
-            key = entry.me_key
-        except ValueError:  # me_key is NULL
-            print('   ' + entry_bits, 'empty')
+        if not address:  # key is NULL
+            rows.append('   ' + entry_bits + ' empty')
             continue
 
-        hash_bits = cbin(entry.me_hash)[-bits:]
+        hash_bits = cbin(h)[-bits:]
         if hash_bits == entry_bits:
-            print('...' + entry_bits, end=' ')
-        else:
-            print('***' + hash_bits, end=' ')
-        print('[%r] =' % (entry.me_key), end=' ')
-        if entry.me_value:
-            print('%r' % entry.me_value)
+            prefix = '...' + entry_bits
         else:
-            print()
+            prefix = '***' + hash_bits
+        rows.append('%s [%r]' % (prefix, do.table[i].key))
+    sys.stdout.write('\n'.join(rows) + '\n')